@@ -1,27 +1,89 @@
 from PyQt5.QtCore import QVariant
-from PyQt5.QtGui import QColor
 from qgis.core import (
     QgsApplication,
     QgsProject,
     QgsVectorLayer,
+    QgsVectorFileWriter,
     QgsField,
+    QgsDistanceArea,
+    QgsUnitTypes,
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsFields,
+    QgsProcessingUtils,
+    QgsGeometry,
+    QgsSpatialIndex,
+    QgsWkbTypes,
     QgsCoordinateReferenceSystem
 )
 from qgis.analysis import QgsNativeAlgorithms
-import qgis.processing
 import processing
+import os
+import hashlib
+import shutil
+import tempfile
 import unicodedata
+import itertools
+from functools import lru_cache
+
+
+@lru_cache(maxsize=32)
+def _crs(authid):
+    """Cria (uma vez por authid) o sistema de referência correspondente"""
+    return QgsCoordinateReferenceSystem(authid)
+
+
+_PROVEDOR_REGISTRADO = False
+
+
+def _registrar_provedor_nativo():
+    """Registra o provedor de algoritmos nativo uma única vez"""
+    global _PROVEDOR_REGISTRADO
+    if _PROVEDOR_REGISTRADO:
+        return
+    registro = QgsApplication.processingRegistry()
+    # No QGIS desktop o provedor já vem registrado
+    if registro.providerById("native") is None:
+        registro.addProvider(QgsNativeAlgorithms())
+    _PROVEDOR_REGISTRADO = True
+
+
+# Camadas de resultado e a tabela correspondente no cache em disco
+TABELAS_RESULTADO = {
+    "Área de supressão em APP": "supressao_app",
+    "Área de supressão em RL": "supressao_rl",
+    "Área de supressão fora": "supressao_fora",
+    "Fora Total": "fora_total",
+}
+
+# Versão do processamento: incremente sempre que o cálculo ou o esquema de saída
+# mudar, para que resultados gravados por código antigo deixem de ser usados
+VERSAO_CACHE = 3
+
+# Quantidade máxima de resultados mantidos no cache (os menos usados saem primeiro)
+LIMITE_CACHE = 20
 
 
 class Interseccao:
     def __init__(self):
         # Registra o provedor de algoritmos nativo
-        QgsApplication.processingRegistry().addProvider(QgsNativeAlgorithms())
+        _registrar_provedor_nativo()
+        # Camadas já corrigidas/reprojetadas, por (id da camada, CRS destino)
+        self._cache_preparo = {}
+        # Pasta dos GeoPackages intermediários (existe só durante o executar)
+        self._tmpdir = None
+        self._seq = itertools.count()
+        # Resultados já calculados, por conteúdo das camadas de entrada
+        self._dir_cache = os.path.join(QgsApplication.qgisSettingsDirPath(), "cache_interseccao")
+        # Camadas publicadas na execução atual, por nome
+        self._resultados = {}
 
     # ------------------------
     # Funções auxiliares
     # ------------------------
-    def normalizar_texto(self, texto):
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def normalizar_texto(texto):
         """Remove acentos e converte para minúsculas"""
         if not texto:
             return ""
@@ -30,35 +92,79 @@ class Interseccao:
             if unicodedata.category(c) != 'Mn'
         )
 
-    def adicionar_campo_area(self, layer):
-        """Adiciona campo 'Area_ha' com cálculo da área"""
+    def adicionar_campo_area(self, layer, materializar=False):
+        """Adiciona campo 'Area_ha' com cálculo da área
+
+        Por padrão o campo é virtual (expressão calculada pelo próprio QGIS);
+        use materializar=True quando os valores precisarem ser gravados.
+        """
         if layer is None or not layer.isValid():
             return
         try:
-            layer.startEditing()
-            if 'Area_ha' not in [f.name() for f in layer.fields()]:
-                layer.addAttribute(QgsField('Area_ha', QVariant.Double))
+            existe = 'Area_ha' in [f.name() for f in layer.fields()]
+            if not materializar and not existe:
+                # $area vem na unidade de área do projeto: converte para hectares
+                fator = QgsUnitTypes.fromUnitToUnitFactor(
+                    QgsProject.instance().areaUnits(), QgsUnitTypes.AreaHectares
+                )
+                layer.addExpressionField(f'round($area * {fator!r}, 4)', QgsField('Area_ha', QVariant.Double))
+                return
+
+            provider = layer.dataProvider()
+            if not existe:
+                provider.addAttributes([QgsField('Area_ha', QVariant.Double)])
                 layer.updateFields()
 
+            # Grava todas as áreas de uma só vez direto no provedor (sem buffer de edição)
             idx = layer.fields().indexFromName('Area_ha')
-            for feat in layer.getFeatures():
+            # Área elipsoidal no CRS da camada (correta também para CRS geográfico)
+            medidor = QgsDistanceArea()
+            medidor.setSourceCrs(layer.crs(), QgsProject.instance().transformContext())
+            medidor.setEllipsoid(QgsProject.instance().ellipsoid())
+            # Métodos resolvidos uma vez, fora do laço
+            medir = medidor.measureArea
+            converter = medidor.convertAreaMeasurement
+            hectares = QgsUnitTypes.AreaHectares
+
+            # Só a geometria é necessária: os atributos não são carregados
+            requisicao = QgsFeatureRequest().setNoAttributes()
+            alteracoes = {}
+            for feat in layer.getFeatures(requisicao):
+                if not feat.hasGeometry():
+                    continue
                 geom = feat.geometry()
-                if geom and not geom.isEmpty():
-                    area_ha = geom.area() / 10000
-                    layer.changeAttributeValue(feat.id(), idx, round(area_ha, 4))
-            layer.commitChanges()
+                if not geom.isEmpty():
+                    alteracoes[feat.id()] = {idx: round(converter(medir(geom), hectares), 4)}
+            provider.changeAttributeValues(alteracoes)
+            layer.updateFields()
         except Exception as e:
             print(f"❌ Erro ao calcular área da camada '{layer.name()}': {e}")
 
+    def filtrar_camadas(self, nomes_camadas, *grupos):
+        """Separa, numa única passada, as camadas de cada grupo de alvos
+
+        Cada camada entra só no primeiro grupo em que algum alvo aparece no seu
+        nome; dentro de um grupo, as camadas seguem a ordem dos alvos.
+        """
+        grupos = [[self.normalizar_texto(a) for a in alvos] for alvos in grupos]
+        encontradas = [{} for _ in grupos]
+        for layer, nome in nomes_camadas.items():
+            for alvos, achadas in zip(grupos, encontradas):
+                i = next((i for i, alvo in enumerate(alvos) if alvo in nome), None)
+                if i is not None:
+                    achadas.setdefault(i, []).append(layer)
+                    break
+        return [[layer for i in sorted(achadas) for layer in achadas[i]] for achadas in encontradas]
+
     def corrigir_geometria(self, layer):
         if layer is None or not layer.isValid():
             return None
         try:
-            res = processing.run("native:fixgeometries", {
-                'INPUT': layer,
-                'OUTPUT': 'memory:'
-            })
-            return res['OUTPUT']
+            # Só roda o fixgeometries se houver alguma geometria inválida
+            requisicao = QgsFeatureRequest().setNoAttributes()
+            if all(f.geometry().isGeosValid() for f in layer.getFeatures(requisicao)):
+                return layer
+            return self._rodar("native:fixgeometries", {'INPUT': layer})
         except Exception as e:
             print(f"❌ Erro ao corrigir geometria da camada '{layer.name()}': {e}")
             return layer
@@ -67,25 +173,302 @@ class Interseccao:
         if layer is None or not layer.isValid():
             return None
         try:
-            crs_destino = QgsCoordinateReferenceSystem(crs_destino_authid)
             if layer.crs().authid() == crs_destino_authid:
                 return layer
-            res = processing.run("native:reprojectlayer", {
-                'INPUT': layer,
-                'TARGET_CRS': crs_destino,
-                'OUTPUT': 'memory:'
-            })
-            return res['OUTPUT']
+            # Reprojeta durante a própria leitura das feições, sem rodar o reprojectlayer
+            requisicao = QgsFeatureRequest().setDestinationCrs(
+                _crs(crs_destino_authid), QgsProject.instance().transformContext()
+            )
+            return layer.materialize(requisicao)
         except Exception as e:
             print(f"❌ Erro ao reprojetar camada '{layer.name()}': {e}")
             return layer
 
+    def _camada_memoria(self, tipo_wkb, crs, campos, nome):
+        """Cria uma camada em memória vazia com o tipo, CRS e campos informados"""
+        tipo = QgsWkbTypes.displayString(tipo_wkb)
+        layer = QgsVectorLayer(tipo, nome, "memory")
+        # CRS atribuído direto (nem todo CRS tem authid para ir na URI)
+        layer.setCrs(crs)
+        layer.dataProvider().addAttributes(campos)
+        layer.updateFields()
+        return layer
+
+    def _camada_vazia_como(self, layer):
+        """Camada em memória vazia com o mesmo tipo, CRS e campos da camada"""
+        return self._camada_memoria(layer.wkbType(), layer.crs(), layer.fields(), layer.name())
+
+    def _copia_multiparte(self, layer, feicoes=()):
+        """Camada em memória multipartes com o CRS e os campos da camada, como sai do native:difference"""
+        copia = self._camada_memoria(QgsWkbTypes.multiType(layer.wkbType()), layer.crs(), layer.fields(), layer.name())
+        multiplas = []
+        for feat in feicoes:
+            if feat.hasGeometry():
+                geom = feat.geometry()
+                geom.convertToMultiType()
+                feat.setGeometry(geom)
+            multiplas.append(feat)
+        copia.dataProvider().addFeatures(multiplas)
+        copia.updateExtents()
+        return copia
+
+    def _rodar(self, algoritmo, parametros):
+        """Roda o algoritmo gravando a saída num GeoPackage temporário"""
+        if self._tmpdir is None:
+            return processing.run(algoritmo, dict(parametros, OUTPUT='memory:'))['OUTPUT']
+        saida = os.path.join(self._tmpdir, f"int_{next(self._seq)}.gpkg")
+        res = processing.run(algoritmo, dict(parametros, OUTPUT=saida))
+        return QgsVectorLayer(res['OUTPUT'], algoritmo.split(':')[-1], 'ogr')
+
+    def _limpar_temporarios(self):
+        """Descarta as camadas preparadas e apaga os GeoPackages intermediários"""
+        self._cache_preparo.clear()
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+
+    def _gravar_gpkg(self, layer, caminho, tabela, acrescentar=True):
+        """Grava a camada numa tabela do GeoPackage
+
+        Cria o arquivo na primeira vez; depois, acrescenta as feições à tabela
+        (acrescentar=True) ou cria/substitui a tabela dentro do mesmo arquivo.
+        """
+        opcoes = QgsVectorFileWriter.SaveVectorOptions()
+        opcoes.driverName = "GPKG"
+        opcoes.layerName = tabela
+        opcoes.forceMulti = True
+        if os.path.exists(caminho):
+            opcoes.actionOnExistingFile = (
+                QgsVectorFileWriter.AppendToLayerAddFields if acrescentar
+                else QgsVectorFileWriter.CreateOrOverwriteLayer
+            )
+        # O 'fid' de origem colidiria com os já gravados; campos virtuais são recalculados
+        campos = layer.fields()
+        atributos = [
+            i for i, f in enumerate(campos)
+            if f.name().lower() != 'fid' and campos.fieldOrigin(i) != QgsFields.OriginExpression
+        ]
+        if atributos:
+            opcoes.attributes = atributos
+        else:
+            opcoes.skipAttributeCreation = True
+        erro, mensagem, _, _ = QgsVectorFileWriter.writeAsVectorFormatV3(
+            layer, caminho, QgsProject.instance().transformContext(), opcoes
+        )
+        if erro != QgsVectorFileWriter.NoError:
+            raise RuntimeError(mensagem)
+
+    def _marcar_origem(self, layer, nome):
+        """Preenche o campo 'layer' com o nome da camada de origem das feições"""
+        provider = layer.dataProvider()
+        if layer.fields().indexFromName('layer') == -1:
+            provider.addAttributes([QgsField('layer', QVariant.String)])
+            layer.updateFields()
+        idx = layer.fields().indexFromName('layer')
+        requisicao = QgsFeatureRequest().setNoAttributes()
+        provider.changeAttributeValues({feat.id(): {idx: nome} for feat in layer.getFeatures(requisicao)})
+
+    def _hash_camada(self, layer):
+        """SHA1 do CRS, das geometrias (WKB) e dos atributos da camada"""
+        h = hashlib.sha1(layer.crs().authid().encode())
+        for feat in layer.getFeatures():
+            h.update(feat.geometry().asWkb().data())
+            h.update(repr(feat.attributes()).encode())
+        return h.hexdigest()
+
+    def _chave_cache(self, camadas, crs_destino_authid, modo):
+        """Chave dos resultados: modo, CRS de destino e conteúdo de cada entrada"""
+        partes = [str(VERSAO_CACHE), modo, crs_destino_authid] + [self._hash_camada(l) for l in camadas]
+        return hashlib.sha1("|".join(partes).encode()).hexdigest()
+
+    def _carregar_cache(self, chave):
+        """Resultados salvos para a chave, como {nome: camada} ({} se não houver)"""
+        caminho = os.path.join(self._dir_cache, f"{chave}.gpkg")
+        if not os.path.exists(caminho):
+            return {}
+        # Marca como usado recentemente, para a limpeza do cache
+        os.utime(caminho)
+        resultados = {}
+        for nome, tabela in TABELAS_RESULTADO.items():
+            layer = QgsVectorLayer(f"{caminho}|layername={tabela}", nome, "ogr")
+            if layer.isValid():
+                # Copia para a memória: edições do usuário não alteram o cache
+                resultados[nome] = layer.materialize(QgsFeatureRequest())
+        return resultados
+
+    def _salvar_cache(self, chave, resultados):
+        """Grava os resultados ({nome: camada}) no cache em disco"""
+        try:
+            os.makedirs(self._dir_cache, exist_ok=True)
+            # Monta o arquivo na pasta temporária e só então move, para nunca deixar um cache pela metade
+            temporario = os.path.join(self._tmpdir, "cache.gpkg")
+            for nome, layer in resultados.items():
+                self._gravar_gpkg(layer, temporario, TABELAS_RESULTADO[nome], acrescentar=False)
+            shutil.move(temporario, os.path.join(self._dir_cache, f"{chave}.gpkg"))
+            self._podar_cache()
+        except Exception as e:
+            print(f"⚠️ Não foi possível salvar o cache dos resultados: {e}")
+
+    def _podar_cache(self):
+        """Mantém no cache só os LIMITE_CACHE resultados usados mais recentemente"""
+        arquivos = [
+            os.path.join(self._dir_cache, nome)
+            for nome in os.listdir(self._dir_cache) if nome.endswith(".gpkg")
+        ]
+        arquivos.sort(key=os.path.getmtime, reverse=True)
+        for caminho in arquivos[LIMITE_CACHE:]:
+            try:
+                os.remove(caminho)
+            except OSError as e:
+                print(f"⚠️ Não foi possível remover '{caminho}' do cache: {e}")
+
+    def _preparar(self, layer, crs_destino_authid):
+        """Reprojeta e corrige a camada, reaproveitando o resultado já calculado"""
+        if layer is None:
+            return self.corrigir_geometria(self.reprojetar_para(layer, crs_destino_authid))
+        chave = (layer.id(), crs_destino_authid)
+        if chave in self._cache_preparo:
+            return self._cache_preparo[chave]
+        resultado = self.corrigir_geometria(self.reprojetar_para(layer, crs_destino_authid))
+        self._cache_preparo[chave] = resultado
+        return resultado
+
+    def unir_camadas(self, camadas):
+        """Mescla as camadas em uma única máscara"""
+        # A mescla fica em memória: as entradas podem repetir valores de 'fid',
+        # que o GeoPackage usaria como chave primária
+        return processing.run("native:mergevectorlayers", {
+            'LAYERS': camadas,
+            'OUTPUT': 'memory:'
+        })['OUTPUT']
+
+    def diferenca_indexada(self, base, mascara):
+        """Diferença feição a feição usando índice espacial sobre a máscara"""
+        indice = QgsSpatialIndex(mascara.getFeatures(), flags=QgsSpatialIndex.FlagStoreFeatureGeometries)
+
+        saida = self._camada_memoria(
+            QgsWkbTypes.multiType(base.wkbType()), base.crs(), base.fields(), base.name()
+        )
+        provider = saida.dataProvider()
+
+        # Métodos resolvidos uma vez, fora do laço
+        consultar = indice.intersects
+        geometria_mascara = indice.geometry
+        unir = QgsGeometry.unaryUnion
+        campos = saida.fields()
+
+        lote = []
+        falhas = 0
+        for feat in base.getFeatures():
+            nova = QgsFeature(campos)
+            nova.setAttributes(feat.attributes())
+            # Feições sem geometria passam adiante, como no native:difference
+            if feat.hasGeometry():
+                geom = feat.geometry()
+                candidatas = consultar(geom.boundingBox())
+                if candidatas:
+                    # Só as feições da máscara que tocam o envelope entram na diferença
+                    recorte = geom.difference(unir([geometria_mascara(c) for c in candidatas]))
+                    if recorte.isNull():
+                        falhas += 1
+                        print(f"❌ Erro na diferença da feição {feat.id()} de '{base.name()}': {recorte.lastError()}")
+                        continue
+                    geom = recorte
+                if geom.isEmpty():
+                    # Totalmente coberta pelas demais camadas
+                    continue
+                geom.convertToMultiType()
+                nova.setGeometry(geom)
+            lote.append(nova)
+            if len(lote) >= 1000:
+                provider.addFeatures(lote)
+                lote = []
+        if lote:
+            provider.addFeatures(lote)
+        saida.updateExtents()
+        if falhas:
+            print(f"⚠️ {falhas} feição(ões) de '{base.name()}' ficaram fora do resultado por erro na diferença.")
+        return saida
+
+    def diferenca_filtrada(self, base, overlay, memoria=False):
+        """native:difference só sobre as feições da base que tocam o overlay
+
+        Feições cujo envelope não cruza nenhuma feição do overlay são copiadas
+        sem passar pelo GEOS. Com memoria=False a diferença completa (quando
+        todas as feições tocam o overlay) vai para um GeoPackage temporário.
+        """
+        # Entradas vazias dispensam o algoritmo
+        if base.featureCount() == 0:
+            return self._copia_multiparte(base)
+        if overlay.featureCount() == 0:
+            return self._copia_multiparte(base, base.getFeatures())
+
+        indice = QgsSpatialIndex(overlay.getFeatures())
+        consultar = indice.intersects
+        tocam, livres = [], []
+        for feat in base.getFeatures():
+            if feat.hasGeometry() and consultar(feat.geometry().boundingBox()):
+                tocam.append(feat)
+            else:
+                livres.append(feat)
+
+        if not livres:
+            parametros = {'INPUT': base, 'OVERLAY': overlay}
+            if memoria:
+                return processing.run("native:difference", dict(parametros, OUTPUT='memory:'))['OUTPUT']
+            return self._rodar("native:difference", parametros)
+        if not tocam:
+            return self._copia_multiparte(base, livres)
+
+        # Diferença apenas das feições que tocam o overlay; as livres entram depois
+        parcial = self._camada_memoria(base.wkbType(), base.crs(), base.fields(), base.name())
+        parcial.dataProvider().addFeatures(tocam)
+        resultado = processing.run("native:difference", {
+            'INPUT': parcial,
+            'OVERLAY': overlay,
+            'OUTPUT': 'memory:'
+        })['OUTPUT']
+        for feat in livres:
+            if feat.hasGeometry():
+                geom = feat.geometry()
+                geom.convertToMultiType()
+                feat.setGeometry(geom)
+        resultado.dataProvider().addFeatures(livres)
+        resultado.updateExtents()
+        return resultado
+
+    def _publicar(self, layer, nome):
+        """Nomeia, calcula a área e adiciona a camada de resultado ao projeto"""
+        layer.setName(nome)
+        self.adicionar_campo_area(layer)
+        QgsProject.instance().addMapLayer(layer)
+        self._resultados[nome] = layer
+
+    def _publicar_cache(self, chave):
+        """Publica os resultados salvos para a chave; retorna False se não houver"""
+        resultados = self._carregar_cache(chave)
+        for nome, layer in resultados.items():
+            self._publicar(layer, nome)
+        if resultados:
+            print("♻️ Entradas sem alteração: resultados carregados do cache.")
+        return bool(resultados)
+
     # ------------------------
     # Processamento principal
     # ------------------------
     def executar(self):
+        self._tmpdir = tempfile.mkdtemp(prefix="interseccao_")
+        try:
+            self._executar()
+        finally:
+            self._limpar_temporarios()
+
+    def _executar(self):
+        self._resultados = {}
         project = QgsProject.instance()
         layers = list(project.mapLayers().values())
+        # Normaliza o nome de cada camada uma única vez
+        nomes_camadas = {layer: self.normalizar_texto(layer.name()) for layer in layers}
 
         # ------------------------
         # Tenta detectar camadas ambientais (APP / RL / Área de Supressão)
@@ -95,21 +478,16 @@ class Interseccao:
             "Área de Preservação Permanente",
             "Reserva legal"
         ]
-        camadas_ambientais = []
-
-        for nome in nomes_ambientais:
-            for layer in layers:
-                if self.normalizar_texto(nome) in self.normalizar_texto(layer.name()):
-                    camadas_ambientais.append(layer)
 
         # ------------------------
         # Se não houver camadas ambientais, usa Camada01–04
         # ------------------------
-        camadas_genericas = []
-        for nome in ["Camada01", "Camada02", "Camada03", "Camada04"]:
-            for layer in layers:
-                if self.normalizar_texto(nome) in self.normalizar_texto(layer.name()):
-                    camadas_genericas.append(layer)
+        nomes_genericos = ["Camada01", "Camada02", "Camada03", "Camada04"]
+
+        # Uma única passada pelas camadas separa os dois grupos
+        camadas_ambientais, camadas_genericas = self.filtrar_camadas(
+            nomes_camadas, nomes_ambientais, nomes_genericos
+        )
 
         # ------------------------
         # PROCESSAMENTO AMBIENTAL
@@ -118,7 +496,13 @@ class Interseccao:
             print("🟤 Processamento ambiental detectado...")
             camada_base = camadas_ambientais[0]
             crs_base = camada_base.crs().authid()
-            camada_base_corr = self.corrigir_geometria(self.reprojetar_para(camada_base, crs_base))
+
+            # Mesmas entradas de uma execução anterior: reaproveita os resultados salvos
+            chave = self._chave_cache(camadas_ambientais[:3], crs_base, "ambiental")
+            if self._publicar_cache(chave):
+                return
+
+            camada_base_corr = self._preparar(camada_base, crs_base)
 
             layer_app = None
             layer_rl = None
@@ -127,7 +511,7 @@ class Interseccao:
             # --- Interseção APP ---
             if len(camadas_ambientais) >= 2:
                 overlay_app = camadas_ambientais[1]
-                overlay_app_corr = self.corrigir_geometria(self.reprojetar_para(overlay_app, crs_base))
+                overlay_app_corr = self._preparar(overlay_app, crs_base)
 
                 try:
                     layer_app = processing.run("native:intersection", {
@@ -135,26 +519,36 @@ class Interseccao:
                         'OVERLAY': overlay_app_corr,
                         'OUTPUT': 'memory:'
                     })['OUTPUT']
-                    layer_app.setName("Área de supressão em APP")
-                    self.adicionar_campo_area(layer_app)
-                    QgsProject.instance().addMapLayer(layer_app)
+                    self._publicar(layer_app, "Área de supressão em APP")
                 except Exception as e:
                     print(f"❌ Erro na interseção APP: {e}")
 
                 # Diferença restante
                 try:
-                    camada_base_corr = processing.run("native:difference", {
-                        'INPUT': camada_base_corr,
-                        'OVERLAY': layer_app if layer_app else overlay_app_corr,
-                        'OUTPUT': 'memory:'
-                    })['OUTPUT']
+                    camada_base_corr = self.diferenca_filtrada(
+                        camada_base_corr, layer_app if layer_app else overlay_app_corr
+                    )
                 except Exception as e:
                     print(f"❌ Erro na diferença APP: {e}")
 
             # --- Interseção RL ---
-            if len(camadas_ambientais) >= 3:
+            if (len(camadas_ambientais) >= 3 and camada_base_corr is not None
+                    and camada_base_corr.featureCount() == 0):
+                # Toda a supressão caiu em APP: RL e fora ficam vazias, sem rodar os algoritmos
+                overlay_rl_corr = self._preparar(camadas_ambientais[2], crs_base)
+                campos_rl = overlay_rl_corr.fields() if overlay_rl_corr is not None else QgsFields()
+                # Mesmo esquema que o native:intersection geraria (campos da RL + campos da base)
+                layer_rl = self._camada_memoria(
+                    QgsWkbTypes.multiType(camada_base_corr.wkbType()),
+                    camada_base_corr.crs(),
+                    QgsProcessingUtils.combineFields(campos_rl, camada_base_corr.fields()),
+                    "Área de supressão em RL"
+                )
+                self._publicar(layer_rl, "Área de supressão em RL")
+                self._publicar(self._camada_vazia_como(camada_base_corr), "Área de supressão fora")
+            elif len(camadas_ambientais) >= 3:
                 overlay_rl = camadas_ambientais[2]
-                overlay_rl_corr = self.corrigir_geometria(self.reprojetar_para(overlay_rl, crs_base))
+                overlay_rl_corr = self._preparar(overlay_rl, crs_base)
 
                 try:
                     layer_rl = processing.run("native:intersection", {
@@ -162,29 +556,26 @@ class Interseccao:
                         'OVERLAY': camada_base_corr,
                         'OUTPUT': 'memory:'
                     })['OUTPUT']
-                    layer_rl.setName("Área de supressão em RL")
-                    self.adicionar_campo_area(layer_rl)
-                    QgsProject.instance().addMapLayer(layer_rl)
+                    self._publicar(layer_rl, "Área de supressão em RL")
                 except Exception as e:
                     print(f"❌ Erro na interseção RL: {e}")
 
                 # Diferença fora
                 try:
-                    layer_fora = processing.run("native:difference", {
-                        'INPUT': camada_base_corr,
-                        'OVERLAY': layer_rl if layer_rl else overlay_rl_corr,
-                        'OUTPUT': 'memory:'
-                    })['OUTPUT']
-                    layer_fora.setName("Área de supressão fora")
-                    self.adicionar_campo_area(layer_fora)
-                    QgsProject.instance().addMapLayer(layer_fora)
+                    layer_fora = self.diferenca_filtrada(
+                        camada_base_corr, layer_rl if layer_rl else overlay_rl_corr, memoria=True
+                    )
+                    self._publicar(layer_fora, "Área de supressão fora")
                 except Exception as e:
                     print(f"❌ Erro na diferença RL/Fora: {e}")
             else:
-                layer_fora = camada_base_corr
-                layer_fora.setName("Área de supressão fora")
-                self.adicionar_campo_area(layer_fora)
-                QgsProject.instance().addMapLayer(layer_fora)
+                # Copia para não renomear a camada de entrada, que pode ter vindo sem alteração
+                layer_fora = camada_base_corr.materialize(QgsFeatureRequest())
+                self._publicar(layer_fora, "Área de supressão fora")
+
+            # Só guarda no cache quando todas as camadas esperadas foram geradas
+            if len(self._resultados) == min(len(camadas_ambientais), 3):
+                self._salvar_cache(chave, self._resultados)
 
         # ------------------------
         # PROCESSAMENTO GENÉRICO (Camada01–04)
@@ -192,27 +583,36 @@ class Interseccao:
         elif len(camadas_genericas) >= 2:
             print("🟢 Processamento genérico detectado...")
             crs_base = camadas_genericas[0].crs().authid()
-            camadas_corr = [self.corrigir_geometria(self.reprojetar_para(l, crs_base)) for l in camadas_genericas]
+
+            chave = self._chave_cache(camadas_genericas, crs_base, "generico")
+            if self._publicar_cache(chave):
+                return
+
+            camadas_corr = [self._preparar(l, crs_base) for l in camadas_genericas]
 
             # Diferença iterativa para "Fora Total"
-            exclusivas = []
+            # Com 3+ camadas o índice espacial seleciona só as feições da máscara próximas
+            indexada = len(camadas_corr) >= 3
+            # Cada área exclusiva vai direto para uma única tabela, sem ficar retida em memória
+            gpkg_fora = os.path.join(self._tmpdir, "fora_total.gpkg")
             for i, base in enumerate(camadas_corr):
-                outras = [c for j, c in enumerate(camadas_corr) if j != i]
-                temp = base
-                for o in outras:
-                    temp = processing.run("native:difference", {'INPUT': temp, 'OVERLAY': o, 'OUTPUT': 'memory:'})['OUTPUT']
-                exclusivas.append(temp)
-
-            # Mescla exclusivas
-            merge_params = {
-                'LAYERS': exclusivas,
-                'CRS': camadas_genericas[0].crs(),
-                'OUTPUT': 'memory:'
-            }
-            fora_total = processing.run("native:mergevectorlayers", merge_params)['OUTPUT']
-            fora_total.setName("Fora Total")
-            self.adicionar_campo_area(fora_total)
-            QgsProject.instance().addMapLayer(fora_total)
+                # Uma única diferença contra as demais camadas, mescladas numa só máscara
+                outras = camadas_corr[:i] + camadas_corr[i + 1:]
+                mascara = outras[0] if len(outras) == 1 else self.unir_camadas(outras)
+                if indexada:
+                    temp = self.diferenca_indexada(base, mascara)
+                else:
+                    temp = self.diferenca_filtrada(base, mascara)
+                # Registra de que camada veio cada área exclusiva
+                self._marcar_origem(temp, camadas_genericas[i].name())
+                self._gravar_gpkg(temp, gpkg_fora, "fora_total")
+                del temp
+
+            # Copia o resultado para a memória (a pasta temporária é apagada ao final)
+            fora_total = QgsVectorLayer(f"{gpkg_fora}|layername=fora_total", "Fora Total", "ogr")
+            fora_total = fora_total.materialize(QgsFeatureRequest())
+            self._publicar(fora_total, "Fora Total")
+            self._salvar_cache(chave, self._resultados)
 
         else:
             print("⚠️ Nenhuma camada válida encontrada para processamento.")